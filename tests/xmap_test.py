@@ -18,7 +18,8 @@ import functools
 import itertools
 import os
 import unittest
-from unittest import SkipTest, skip, skipIf
+from typing import Dict, Tuple
+from unittest import SkipTest, mock, skip, skipIf
 
 import numpy as np
 from absl.testing import absltest
@@ -28,11 +29,12 @@ from functools import partial
 import jax
 import jax.numpy as jnp
 from jax import test_util as jtu
+from jax import tree_util
 from jax import vmap
 from jax import lax
 from jax.experimental.maps import Mesh, mesh, xmap, A
 from jax.lib import xla_bridge
-from jax.util import curry, unzip2
+from jax.util import curry, prod, unzip2
 from jax.interpreters import pxla
 
 from jax.config import config
@@ -51,108 +53,141 @@ def setUpModule():
   if "xla_force_host_platform_device_count" not in flags_str:
     os.environ["XLA_FLAGS"] = (flags_str +
                                " --xla_force_host_platform_device_count=8")
-  # Clear any cached backends so new CPU backend will pick up the env var.
-  xla_bridge.get_backend.cache_clear()
+    # Clear any cached backends so new CPU backend will pick up the env var.
+    xla_bridge.get_backend.cache_clear()
 
 # Reset to previous configuration in case other test modules will be run.
 def tearDownModule():
-  if prev_xla_flags is None:
-    del os.environ["XLA_FLAGS"]
-  else:
-    os.environ["XLA_FLAGS"] = prev_xla_flags
-  xla_bridge.get_backend.cache_clear()
+  if os.getenv("XLA_FLAGS") != prev_xla_flags:
+    if prev_xla_flags is None:
+      del os.environ["XLA_FLAGS"]
+    else:
+      os.environ["XLA_FLAGS"] = prev_xla_flags
+    xla_bridge.get_backend.cache_clear()
+  # The cached devices belong to the backend we might have just dropped.
+  global _local_devices
+  _local_devices = None
+  _MESH_CACHE.clear()
 
 
+_local_devices = None
+
+def _cached_local_devices():
+  global _local_devices
+  if _local_devices is None:
+    _local_devices = np.array(jax.local_devices(), dtype=object)
+  return _local_devices
+
+_MESH_CACHE: Dict[Tuple, np.ndarray] = {}
+
 @curry
 def with_mesh(named_shape, f):
+  key = tuple(named_shape)
+  axis_names, shape = unzip2(named_shape)
+  size = prod(shape)
   def new_f(*args, **kwargs):
-    axis_names, shape = unzip2(named_shape)
-    size = np.prod(shape)
-    local_devices = list(jax.local_devices())
-    if len(local_devices) < size:
-      raise SkipTest(f"Test requires {size} local devices")
-    mesh_devices = np.array(local_devices[:size]).reshape(shape)
+    mesh_devices = _MESH_CACHE.get(key)
+    if mesh_devices is None:
+      local_devices = _cached_local_devices()
+      if local_devices.size < size:
+        raise SkipTest(f"Test requires {size} local devices")
+      mesh_devices = _MESH_CACHE[key] = local_devices[:size].reshape(shape)
     with mesh(mesh_devices, axis_names):
       return f(*args, **kwargs)
   return new_f
 
-def use_spmd_lowering(f):
-  def new_f(*args, **kwargs):
-    if jtu.device_under_test() != "tpu":
-      raise SkipTest
-    jax.experimental.maps.make_xmap_callable.cache_clear()
-    old = jax.experimental.maps.EXPERIMENTAL_SPMD_LOWERING
-    jax.experimental.maps.EXPERIMENTAL_SPMD_LOWERING = True
-    try:
-      return f(*args, **kwargs)
-    finally:
-      jax.experimental.maps.EXPERIMENTAL_SPMD_LOWERING = old
-  return new_f
-
-
-class XMapTest(jtu.JaxTestCase):
+@partial(jax.jit, static_argnums=0)
+def _iota(shape):
+  # Same values and dtype as jnp.arange(prod(shape)).reshape(shape), but built
+  # on device in a single computation.
+  return lax.iota(jnp.int_, prod(shape)).reshape(shape)
+
+# Axis specifications and schedule shared by testBasic and testBasicCollective.
+_BASIC_IN_AXES = (A({'a': 0, 'b': 1}), A({'c': 0}))
+_BASIC_OUT_AXES = _BASIC_IN_AXES
+_BASIC_SCHEDULE = (
+  ('a', 'x'),
+  ('b', 'y'),
+  ('c', 'x'),
+  ('a', 'vectorize'),
+  ('b', 'vectorize'),
+)
+
+_EMPTY_MESH_DEVICES = np.empty((), dtype=object)
+
+
+class XMapTestCase(jtu.JaxTestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # Test inputs are deterministic, so build each of them only once per class.
+    cls._arange_cache = {}
+    cls._randn_cache = {}
+
+  @classmethod
+  def tearDownClass(cls):
+    del cls._arange_cache
+    del cls._randn_cache
+    super().tearDownClass()
 
   def setUp(self):
     if not config.omnistaging_enabled:
       raise SkipTest("xmap requires omnistaging")
 
+  def _arange(self, shape):
+    x = self._arange_cache.get(shape)
+    if x is None:
+      x = _iota(shape)
+      self._arange_cache[shape] = x
+    return x
+
+  def _randn(self, seed, *shapes):
+    key = (seed, shapes)
+    xs = self._randn_cache.get(key)
+    if xs is None:
+      rng = np.random.RandomState(seed)
+      xs = tuple(jax.device_put(rng.randn(*shape).astype(np.float32))
+                 for shape in shapes)
+      self._randn_cache[key] = xs
+    return xs
+
+
+class XMapTest(XMapTestCase):
+
   @ignore_xmap_warning()
+  @with_mesh([('x', 2), ('y', 2)])
   def testBasic(self):
-    local_devices = list(jax.local_devices())
-    if len(local_devices) < 4:
-      raise SkipTest("Test requires at least 4 local devices")
     def f(a, b):
       return a * 2, b * 4
-    devices = np.array(local_devices[:4]).reshape((2, 2))
-    with mesh(devices, ('x', 'y')):
-      fm = xmap(f,
-                in_axes=[A({'a': 0, 'b': 1}), A({'c': 0})],
-                out_axes=[A({'a': 0, 'b': 1}), A({'c': 0})],
-                schedule=[
-                  ('a', 'x'),
-                  ('b', 'y'),
-                  ('c', 'x'),
-                  ('a', 'vectorize'),
-                  ('b', 'vectorize'),
-                ])
-      ashape = (16, 8, 5)
-      a = jnp.arange(np.prod(ashape)).reshape(ashape)
-      bshape = (2, 7)
-      b = jnp.arange(np.prod(bshape)).reshape(bshape)
-      c, d = fm(a, b)
-      self.assertAllClose(c, a * 2)
-      self.assertAllClose(d, b * 4)
-
-  testBasicSPMD = use_spmd_lowering(testBasic)
+    fm = xmap(f,
+              in_axes=_BASIC_IN_AXES,
+              out_axes=_BASIC_OUT_AXES,
+              schedule=_BASIC_SCHEDULE)
+    ashape = (16, 8, 5)
+    a = self._arange(ashape)
+    bshape = (2, 7)
+    b = self._arange(bshape)
+    c, d = tree_util.tree_map(lambda x: x.block_until_ready(), fm(a, b))
+    self.assertAllClose(c, np.asarray(a) * 2)
+    self.assertAllClose(d, np.asarray(b) * 4)
 
   @ignore_xmap_warning()
+  @with_mesh([('x', 2), ('y', 2)])
   def testBasicCollective(self):
-    local_devices = list(jax.local_devices())
-    if len(local_devices) < 4:
-      raise SkipTest("Test requires at least 4 local devices")
     def f(a, b):
       return lax.psum(a * 2, 'a'), b * 4
-    devices = np.array(local_devices[:4]).reshape((2, 2))
-    with mesh(devices, ('x', 'y')):
-      fm = xmap(f,
-                in_axes=[A({'a': 0, 'b': 1}), A({'c': 0})],
-                out_axes=[A({'b': 0}), A({'c': 0})],
-                schedule=[
-                  ('a', 'x'),
-                  ('b', 'y'),
-                  ('c', 'x'),
-                  ('a', 'vectorize'),
-                  ('b', 'vectorize'),
-                ])
-      ashape = (16, 8, 5)
-      a = jnp.arange(np.prod(ashape)).reshape(ashape)
-      bshape = (2, 7)
-      b = jnp.arange(np.prod(bshape)).reshape(bshape)
-      c, d = fm(a, b)
-      self.assertAllClose(c, (a * 2).sum(0))
-      self.assertAllClose(d, b * 4)
-
-  testBasicCollectiveSPMD = use_spmd_lowering(testBasicCollective)
+    fm = xmap(f,
+              in_axes=_BASIC_IN_AXES,
+              out_axes=[A({'b': 0}), A({'c': 0})],
+              schedule=_BASIC_SCHEDULE)
+    ashape = (16, 8, 5)
+    a = self._arange(ashape)
+    bshape = (2, 7)
+    b = self._arange(bshape)
+    c, d = tree_util.tree_map(lambda x: x.block_until_ready(), fm(a, b))
+    self.assertAllClose(c, np.asarray(a).sum(0) * 2)
+    self.assertAllClose(d, np.asarray(b) * 4)
 
   @ignore_xmap_warning()
   @with_mesh([('x', 2)])
@@ -165,10 +200,12 @@ class XMapTest(jtu.JaxTestCase):
               out_axes=A({'a': 0}),
               schedule=[('a', 'x'), ('a', 'vectorize')])
     x = np.arange(8).reshape((2, 2, 2))
+    # make_xmap_callable is an lu.cache, which exposes no hit statistics, so a
+    # cache hit is verified by calling fm again with tracing disallowed.
     python_should_be_executing = True
-    fm(x)
+    fm(x).block_until_ready()
     python_should_be_executing = False
-    fm(x)
+    fm(x).block_until_ready()
 
   @ignore_xmap_warning()
   @with_mesh([('x', 2)])
@@ -183,9 +220,9 @@ class XMapTest(jtu.JaxTestCase):
         return jnp.sin(y)
       return h(y)
     xshape = (4, 2, 5)
-    x = jnp.arange(np.prod(xshape)).reshape(xshape)
+    x = self._arange(xshape)
     self.assertAllClose(f(x),
-                        jnp.sin(x * 2).transpose((1, 2, 0)))
+                        np.sin(np.asarray(x) * 2).transpose((1, 2, 0)))
 
   @ignore_xmap_warning()
   @with_mesh([('x', 2), ('y', 3)])
@@ -200,9 +237,9 @@ class XMapTest(jtu.JaxTestCase):
         return jnp.sin(y)
       return h(y)
     xshape = (2, 3, 5)
-    x = jnp.arange(np.prod(xshape)).reshape(xshape)
+    x = self._arange(xshape)
     y = f(x)
-    self.assertAllClose(y, jnp.sin(x * 2).transpose((1, 2, 0)))
+    self.assertAllClose(y, np.sin(np.asarray(x) * 2).transpose((1, 2, 0)))
     # Make sure the op really ran accros a 2D mesh.
     self.assertEqual(y.sharding_spec.sharding,
                      (pxla.Chunked(3), None, None))
@@ -215,14 +252,14 @@ class XMapTest(jtu.JaxTestCase):
     @partial(xmap, in_axes=A({'a': 0}), out_axes=A({'a': 0}),
              schedule=[('a', 'x')])
     def f(x):
-      with mesh(np.empty((), dtype=np.object), ()):
+      with mesh(_EMPTY_MESH_DEVICES, ()):
         @partial(xmap, in_axes=A({'b': 0}), out_axes=A({'b': 0}),
                  schedule=[('b', 'vectorize')])
         def h(x):
           return x
         return h(x)
     xshape = (2, 5, 6)
-    x = jnp.arange(np.prod(xshape)).reshape(xshape)
+    x = self._arange(xshape)
     with self.assertRaisesRegex(RuntimeError,
                                 "Changing the resource environment.*"):
       f(x)
@@ -236,13 +273,11 @@ class XMapTest(jtu.JaxTestCase):
     f_mapped = xmap(f, in_axes=[A({'i': 1}), A({'i': 0})], out_axes=A(),
                     schedule=[('i', 'r1'), ('i', 'vectorize')])
 
-    rng = np.random.RandomState(0)
-    x = rng.randn(3, 8)
-    y = rng.randn(8, 5)
+    x, y = self._randn(0, (3, 8), (8, 5))
 
-    z = f_mapped(x, y)
+    z = f_mapped(x, y).block_until_ready()
 
-    self.assertAllClose(z, jnp.dot(x, y))
+    self.assertAllClose(z, np.dot(np.asarray(x), np.asarray(y)))
 
   @ignore_xmap_warning()
   @with_mesh([('r1', 2)])
@@ -250,18 +285,41 @@ class XMapTest(jtu.JaxTestCase):
     def f(x, y):
       return lax.pdot(x, y, 'i')
 
-    rng = np.random.RandomState(0)
-    x = rng.randn(2, 3, 8)
-    y = rng.randn(2, 8, 5)
+    x, y = self._randn(0, (2, 3, 8), (2, 8, 5))
 
     f_mapped = xmap(f,
                     in_axes=[A({'i': 2, 'j': 0}), A({'i': 1, 'j': 0})],
                     out_axes=A({'j': 0}),
                     schedule=[('j', 'vectorize'), ('i', 'r1'), ('i', 'vectorize')])
 
-    z = f_mapped(x, y)
+    z = f_mapped(x, y).block_until_ready()
+
+    self.assertAllClose(z, np.einsum('nij,njk->nik', np.asarray(x),
+                                     np.asarray(y)))
+
+class XMapTestSPMD(XMapTestCase):
+  """Re-runs a subset of XMapTest with the experimental SPMD lowering."""
+
+  @classmethod
+  def setUpClass(cls):
+    if jtu.device_under_test() != "tpu":
+      raise SkipTest("SPMD lowering is only supported on TPU")
+    super().setUpClass()
+    cls._spmd_lowering = mock.patch.object(
+        jax.experimental.maps, "EXPERIMENTAL_SPMD_LOWERING", True)
+    cls._spmd_lowering.start()
+    # make_xmap_callable doesn't key on the lowering mode, so keep its cached
+    # callables from leaking into or out of this class.
+    jax.experimental.maps.make_xmap_callable.cache_clear()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls._spmd_lowering.stop()
+    jax.experimental.maps.make_xmap_callable.cache_clear()
+    super().tearDownClass()
 
-    self.assertAllClose(z, jnp.einsum('nij,njk->nik', x, y))
+  testBasic = XMapTest.testBasic
+  testBasicCollective = XMapTest.testBasicCollective
 
 if __name__ == '__main__':
   absltest.main(testLoader=jtu.JaxTestLoader())